@@ -3,6 +3,22 @@
 import json
 import os
 
+
+def data_stores(content: dict) -> list:
+    """List the data stores referenced by a Vitessce configuration."""
+    urls = set(
+        file["url"]
+        for dataset in content.get("datasets", [])
+        for file in dataset.get("files", [])
+        if file.get("url")
+    )
+    # Paths are relative to the configuration file
+    return sorted(
+        url[len("./"):] if url.startswith("./") else url
+        for url in urls
+    )
+
+
 chart_manifest = []
 
 for fp in os.listdir("."):
@@ -12,8 +28,9 @@ for fp in os.listdir("."):
             type="vitessce",
             config=fp,
             name=content.get("name", ""),
-            desc=content.get("description", "")
+            desc=content.get("description", ""),
+            data=data_stores(content)
         ))
 
-with open("chart.manifest.pipeline.json", "w") as handle:
+with open("chart.manifest.json", "w") as handle:
     json.dump(chart_manifest, handle, indent=4)
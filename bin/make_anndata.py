@@ -13,6 +13,7 @@ from vitessce import (
     AnnDataWrapper
 )
 from vitessce.data_utils.anndata import optimize_adata
+import zarr
 
 # Set up logging
 logFormatter = logging.Formatter(
@@ -27,19 +28,31 @@ consoleHandler.setFormatter(logFormatter)
 logger.addHandler(consoleHandler)
 
 
+# Summary statistics for each gene (computed during validation)
+# which are added to the gene annotations
+GENE_SUMMARY_COLS = ["total", "mean", "variance", "n_zero"]
+
+
 def make_anndata(
     category: str,
     res: pd.DataFrame,
     manifest: pd.DataFrame,
     counts: pd.DataFrame,
+    sample_summary: pd.DataFrame,
+    gene_summary: pd.DataFrame,
     scale_factor=1e6
 ) -> AnnData:
 
-    # Make an AnnData object (scaling to CPM)
+    # Make an AnnData object (scaling to CPM with the library
+    # sizes computed from all genes during validation)
     # Transposing so that samples are on the .obs axis
     logger.info("Scaling input data")
+    # Specimens are in the same order in both tables
+    msg = "Number of specimens does not match between the counts and summary"
+    assert sample_summary.shape[0] == counts.shape[1], msg
+    lib_size = sample_summary["lib_size"].values
     adata = AnnData(
-        (scale_factor * counts / counts.sum()).T,
+        (scale_factor * counts / lib_size).T,
         dtype=np.float32
     )
     sc.pp.log1p(adata)
@@ -69,7 +82,12 @@ def make_anndata(
         .assign(
             neg_log10_pvalue=lambda d: -d['qvalue'].apply(np.log10),
             top_significant=lambda d: top_significant(d),
-            mean_abund=adata.to_df().mean()
+            # The mean of the log-scaled CPM values, which cannot be derived
+            # from the summary of the raw counts computed during validation
+            mean_abund=pd.Series(
+                np.asarray(adata.X.mean(axis=0)).ravel(),
+                index=adata.var_names
+            )
         )
     )
 
@@ -77,6 +95,10 @@ def make_anndata(
     for kw, val in res.items():
         adata.var[kw] = val
 
+    # Add the summary statistics for each gene
+    for kw in GENE_SUMMARY_COLS:
+        adata.var[kw] = gene_summary[kw]
+
     # Format the volcano plot and MA plot with plotting coordinates
     adata.varm["results"] = (
         res
@@ -288,7 +310,7 @@ def save_anndata(adata: AnnData, category: str):
         "neg_log10_pvalue",
         "mean_abund",
         "top_significant"
-    ]
+    ] + GENE_SUMMARY_COLS
 
     samples_adata: AnnData = optimize_adata(
         adata,
@@ -298,7 +320,7 @@ def save_anndata(adata: AnnData, category: str):
     )
     logger.info("Writing samples to h5ad and zarr")
     samples_adata.write_h5ad(f"{category}.samples.h5ad", compression="gzip")
-    samples_adata.write_zarr(f"{category}.samples.zarr")
+    write_web_zarr(samples_adata, f"{category}.samples.zarr")
     # Write out the PCA coordinates and UMAP coordinates
     write_coordinates(samples_adata, "pca", "PC", n=3)
     write_coordinates(samples_adata, "umap", "UMAP", n=2)
@@ -311,7 +333,24 @@ def save_anndata(adata: AnnData, category: str):
     )
     logger.info("Writing genes to h5ad and zarr")
     genes_adata.write_h5ad(f"{category}.genes.h5ad", compression="gzip")
-    genes_adata.write_zarr(f"{category}.genes.zarr")
+    write_web_zarr(genes_adata, f"{category}.genes.zarr")
+
+
+def write_web_zarr(adata: AnnData, fp: str, chunk_bytes=8e6):
+    """
+    Write to zarr for the web, with the matrix split into as few chunks
+    as possible (each holding all observations for a block of variables,
+    up to ~chunk_bytes) and all of the metadata consolidated into a single
+    .zmetadata file, so that the store can be published and fetched with
+    a small number of requests.
+    """
+
+    n_obs, n_vars = adata.shape
+    col_bytes = max(1, n_obs * adata.X.dtype.itemsize)
+    n_cols = int(min(n_vars, max(1, chunk_bytes // col_bytes)))
+
+    adata.write_zarr(fp, chunks=(n_obs, n_cols))
+    zarr.consolidate_metadata(fp)
 
 
 def write_coordinates(adata: AnnData, kw: str, label: str, n: int):
@@ -336,6 +375,8 @@ if __name__ == "__main__":
     DE_results = pd.read_csv("DE_results.csv")
     manifest = pd.read_csv("manifest.csv", index_col=0)
     counts = pd.read_csv("counts.csv", index_col=0)
+    sample_summary = pd.read_csv("summary.samples.csv", index_col=0)
+    gene_summary = pd.read_csv("summary.genes.csv", index_col=0)
 
     # Process each of the DA analyses
     for category, res in DE_results.groupby("variable"):
@@ -347,7 +388,14 @@ if __name__ == "__main__":
         logger.info(f"Processing results for '{category}'")
 
         # Make the AnnData object
-        adata = make_anndata(category, res, manifest, counts)
+        adata = make_anndata(
+            category,
+            res,
+            manifest,
+            counts,
+            sample_summary,
+            gene_summary
+        )
 
         # Save to H5AD
         # Note: This will save the data in two both orientations
@@ -12,9 +12,15 @@ workflow {
     log.info"""
 Differential Expression
 
+    samplesheet:        ${params.samplesheet}
     manifest:           ${params.manifest}
     counts:             ${params.counts}
+    feature_map:        ${params.feature_map}
+    h5ad:               ${params.h5ad}
+    sample_key:         ${params.sample_key}
+    h5ad_layer:         ${params.h5ad_layer}
     algorithm:          ${params.algorithm}
+    deseq2_fast:        ${params.deseq2_fast}
     comp_col:           ${params.comp_col}
     comp_ref:           ${params.comp_ref}
     group_cols:         ${params.group_cols}
@@ -26,21 +32,53 @@ Differential Expression
     large_n:            ${params.large_n}
     min_prop:           ${params.min_prop}
     fdr_method:         ${params.fdr_method}
+    shared_norm:        ${params.shared_norm}
+    de_worker:          ${params.de_worker}
+    permutations:       ${params.permutations}
+    max_cpus:           ${params.max_cpus}
+    max_memory_gb:      ${params.max_memory_gb}
     container__pandas:  ${params.container__pandas}
     container__deseq2:  ${params.container__deseq2}
     container__edgeR:   ${params.container__edgeR}
     """
 
+    // Each row of the --samplesheet defines a project, with any settings
+    // not provided in the samplesheet taken from the parameters.
+    // Without a samplesheet, a single project is defined by the parameters.
+    if ( params.samplesheet ) {
+        rows = file("${params.samplesheet}", checkIfExists: true).splitCsv(header: true)
+
+        // The id of each project must be unique, as it is used to
+        // match up the outputs from each project
+        def duplicated = rows.countBy { it.id }.findAll { id, n -> n > 1 }.keySet()
+        if ( duplicated ) {
+            throw new Exception("""Duplicated id in samplesheet: ${duplicated.join(', ')}""")
+        }
+
+        // Each project must also be written to a different output folder
+        duplicated = rows.countBy { it.output_prefix ?: it.id }.findAll { prefix, n -> n > 1 }.keySet()
+        if ( duplicated ) {
+            throw new Exception("""Duplicated output_prefix in samplesheet: ${duplicated.join(', ')}""")
+        }
+
+        rows_ch = Channel.fromList(rows)
+    } else {
+        rows_ch = Channel.of([:])
+    }
+
     // Validate the contents of --counts and align the
     // column order with rows in --manifest
-    validate()
+    validate(
+        rows_ch
+    )
 
     // Run the indicated test library on the counts table
     test(
-        validate.out
+        validate.out.validated
     )
 
     collect(
+        validate.out.projects,
         test.out.results,
         test.out.filtered
     )
@@ -1,14 +1,16 @@
+include { estimate_cpus; estimate_memory } from './resources'
+
 // Collect all of the results into a single table
 process all {
     container "${params.container__pandas}"
     label "io_limited"
-    publishDir "${params.output_folder}", mode: "copy", overwrite: true
-    
+    publishDir "${project.output_folder}", mode: "copy", overwrite: true
+
     input:
-    path "*"
+    tuple val(project), path("*")
 
     output:
-    path "DE_results.csv"
+    tuple val(project), path("DE_results.csv")
 
     script:
     // Run the script in templates/collect_all.py
@@ -18,21 +20,22 @@ process all {
 
 process anndata {
     container "${params.container__pandas}"
-    label "io_limited"
-    publishDir "${params.output_folder}", mode: "copy", overwrite: true, pattern: "*.h5ad"
-    publishDir "${params.output_folder}", mode: "copy", overwrite: true, pattern: "*.csv"
-    publishDir "${params.web_folder}", mode: "copy", overwrite: true, pattern: "*.zarr", enabled: "${params.web_folder}" != "false"
-    publishDir "${params.web_folder}", mode: "copy", overwrite: true, pattern: "*.vt.json", enabled: "${params.web_folder}" != "false"
+    label "dynamic"
+    cpus { estimate_cpus(meta, "anndata") }
+    memory { estimate_memory(meta, "anndata", task.attempt) }
+    publishDir "${meta.output_folder}", mode: "copy", overwrite: true, pattern: "*.h5ad"
+    publishDir "${meta.output_folder}", mode: "copy", overwrite: true, pattern: "*.csv"
+    publishDir "${meta.web_folder}", mode: "copy", overwrite: true, pattern: "*.zarr", enabled: "${params.web_folder}" != "false"
+    publishDir "${meta.web_folder}", mode: "copy", overwrite: true, pattern: "*.vt.json", enabled: "${params.web_folder}" != "false"
 
     input:
-    path "DE_results.csv"
-    tuple path("manifest.csv"), path("counts.csv")
+    tuple val(meta), path("DE_results.csv"), path("manifest.csv"), path("counts.csv"), path(summary)
 
     output:
-    path "*.h5ad", emit: h5ad
-    path "*.zarr", hidden: true, emit: zarr
-    path "*.vt.json", emit: vt_json
-    path "*.csv", emit: csv
+    tuple val(meta), path("*.h5ad"), emit: h5ad
+    tuple val(meta), path("*.zarr", hidden: true), emit: zarr
+    tuple val(meta), path("*.vt.json"), emit: vt_json
+    tuple val(meta), path("*.csv"), emit: csv
 
     """#!/bin/bash
 set -e
@@ -42,15 +45,15 @@ make_anndata.py
 }
 
 process manifest {
-    publishDir "${params.web_folder}", mode: "copy", overwrite: true, enabled: "${params.web_folder}" != "false"
+    publishDir "${project.web_folder}", mode: "copy", overwrite: true, enabled: "${params.web_folder}" != "false"
     container "${params.container__pandas}"
     label "io_limited"
 
     input:
-    path "*"
+    tuple val(project), path("*")
 
     output:
-    path "chart.manifest.json"
+    tuple val(project), path("chart.manifest.json")
 
     """#!/bin/bash
 set -e
@@ -59,22 +62,54 @@ chart_manifest.py
 
 }
 
+// Group the outputs from each comparison by project, emitting each
+// project as soon as all of its comparisons are complete
+def group_by_project(ch) {
+    return ch
+        .map { meta, fps -> [groupKey(meta.id, meta.n_comparisons), fps] }
+        .groupTuple()
+        .map { id, fps -> [id.toString(), fps.flatten()] }
+}
+
 workflow collect {
     take:
+    // The settings for each project
+    projects_ch
     // A collection of CSVs with results from a differential expression test
     results_csv_ch
-    // The filtered counts and manifest used to run the tests
+    // The filtered counts and manifest used to run the tests,
+    // with the summary statistics computed during validation
     filtered_ch
 
     main:
 
-    // Collect all of the results
-    all(results_csv_ch.toSortedList())
+    projects_by_id = projects_ch.map { project -> [project.id, project] }
+
+    // Collect all of the results for each project
+    all(
+        group_by_project(results_csv_ch)
+            .join(projects_by_id)
+            .map { id, csvs, project -> [project, csvs] }
+    )
 
     // Format as AnnData
-    anndata(all.out.toSortedList(), filtered_ch)
+    anndata(
+        filtered_ch
+            .map { meta, manifest_csv, counts_csv, summary_csvs -> [meta.id, meta, manifest_csv, counts_csv, summary_csvs] }
+            .combine(
+                all.out.map { project, results_csv -> [project.id, results_csv] },
+                by: 0
+            )
+            .map {
+                id, meta, manifest_csv, counts_csv, summary_csvs, results_csv -> [meta, results_csv, manifest_csv, counts_csv, summary_csvs]
+            }
+    )
 
     // Format the chart.manifest.json
-    manifest(anndata.out.vt_json.toSortedList())
+    manifest(
+        group_by_project(anndata.out.vt_json)
+            .join(projects_by_id)
+            .map { id, vt_json, project -> [project, vt_json] }
+    )
 
-}
\ No newline at end of file
+}
@@ -0,0 +1,70 @@
+// Estimate the resources needed for each task from the size of the
+// comparison, as reported by validation (stats.json)
+
+// Cost model for each type of task
+//   memory (GB) = mem_base + mem_per_mvalue * (genes x samples / 1e6)
+//   cpus        = samples / samples_per_cpu (single-threaded if 0)
+// The coefficients should be recalibrated by regressing the peak_rss
+// column of the Nextflow trace report against genes x samples
+def cost_model(String task_type) {
+    def models = [
+        filter:     [mem_base: 1, mem_per_mvalue: 0.10, samples_per_cpu: 0],
+        deseq2:     [mem_base: 2, mem_per_mvalue: 0.25, samples_per_cpu: 50],
+        edgeR:      [mem_base: 1, mem_per_mvalue: 0.15, samples_per_cpu: 0],
+        limma_voom: [mem_base: 1, mem_per_mvalue: 0.12, samples_per_cpu: 0],
+        anndata:    [mem_base: 2, mem_per_mvalue: 0.20, samples_per_cpu: 0],
+    ]
+    if ( !models.containsKey(task_type) ) {
+        throw new Exception("""No cost model defined for: ${task_type}""")
+    }
+    return models[task_type]
+}
+
+// Number of CPUs to request for a task
+def estimate_cpus(Map stats, String task_type) {
+    def model = cost_model(task_type)
+    if ( model.samples_per_cpu == 0 ) {
+        return 1
+    }
+    def cpus = Math.ceil(stats.n_samples / model.samples_per_cpu) as int
+    return Math.max(1, Math.min(cpus, params.max_cpus as int))
+}
+
+// Amount of memory to request for a task, growing with each retry
+def estimate_memory(Map stats, String task_type, int attempt) {
+    def model = cost_model(task_type)
+    def mvalues = (stats.n_genes * stats.n_samples) / 1e6
+    def gb = Math.ceil((model.mem_base + model.mem_per_mvalue * mvalues) * attempt) as int
+    return "${Math.min(gb, params.max_memory_gb as int)} GB"
+}
+
+// Permutation testing scales with the number of permutations, and so
+// the permute task is sized from genes x samples x permutations
+//   cpus        = genes x samples x permutations / values_per_cpu,
+//                 up to the number of blocks of permutations
+//   memory (GB) = mem_base + one copy of the abundances for each process
+//                 (plus the tables read in by the main process)
+//                 + one block of permutation statistics for each worker
+def permute_model() {
+    return [mem_base: 1, values_per_cpu: 5e8, main_copies: 4]
+}
+
+// Number of CPUs (worker processes) to request for the permute task
+def estimate_permute_cpus(Map stats) {
+    def model = permute_model()
+    def values = (stats.n_genes as long) * stats.n_samples * (params.permutations as long)
+    def n_blocks = Math.ceil((params.permutations as int) / (params.perm_block_size as int)) as int
+    def cpus = Math.ceil(values / model.values_per_cpu) as int
+    return Math.max(1, Math.min(cpus, Math.min(n_blocks, params.max_cpus as int)))
+}
+
+// Amount of memory to request for the permute task, growing with each retry
+def estimate_permute_memory(Map stats, int attempt) {
+    def model = permute_model()
+    def cpus = estimate_permute_cpus(stats)
+    // Size of a single gene x sample matrix, and of a single block of statistics
+    def abund_gb = (stats.n_genes as long) * stats.n_samples * 8 / 1e9
+    def block_gb = (stats.n_genes as long) * (params.perm_block_size as int) * 9 / 1e9
+    def gb = model.mem_base + (model.main_copies + cpus) * abund_gb + cpus * block_gb
+    return "${Math.min(Math.ceil(gb * attempt) as int, params.max_memory_gb as int)} GB"
+}
@@ -1,15 +1,29 @@
+include { estimate_cpus; estimate_memory; estimate_permute_cpus; estimate_permute_memory } from './resources'
+
+// The resident R worker (bin/de_worker.R) is only used when it was selected
+// and the tasks run directly on the local node, outside of any container
+def use_de_worker(task) {
+    return params.de_worker && (task.executor ?: "local") == "local" && !workflow.containerEngine
+}
+
 // Filter genes with the filterbyExpr package
 process filter {
     container "${params.container__edgeR}"
-    label "io_limited"
+    label "dynamic"
+    cpus { estimate_cpus(meta, "filter") }
+    memory { estimate_memory(meta, "filter", task.attempt) }
+    // Jobs run by the resident R worker are limited to the CPUs of the task
+    beforeScript { "export DE_WORKER_TASK_CPUS=${task.cpus}" }
     
     input:
-    tuple path(manifest), path("raw.counts.csv")
+    tuple val(meta), path(manifest), path("raw.counts.csv"), path(summary)
 
     output:
-    tuple path("${manifest.name}"), path("counts.csv")
+    tuple val(meta), path("${manifest.name}"), path("counts.csv"), path("summary.*.csv", includeInputs: true)
 
     script:
+    // Run with the resident R worker on this node, if selected
+    interpreter = use_de_worker(task) ? "de_worker_client" : "Rscript"
     template "filterbyExpr.R"
 
 }
@@ -17,18 +31,31 @@ process filter {
 // Run the DESeq2 algorithm
 process deseq2 {
     container "${params.container__deseq2}"
-    label "mem_medium"
-    publishDir "${params.output_folder}", mode: "copy", overwrite: true
+    label "dynamic"
+    cpus { estimate_cpus(meta, "deseq2") }
+    memory { estimate_memory(meta, "deseq2", task.attempt) }
+    // Jobs run by the resident R worker are limited to the CPUs of the task
+    beforeScript { "export DE_WORKER_TASK_CPUS=${task.cpus}" }
+    publishDir "${meta.output_folder}", mode: "copy", overwrite: true
     
     input:
     // Input file will be placed in the working directory with this name
-    tuple path(manifest), path(counts)
+    tuple val(meta), path(manifest), path(counts), path(summary)
 
     output:
     // If validation was successful, the output will be written with this path
-    path "*.DEseq2.csv"
+    tuple val(meta), path("*.DEseq2.csv")
 
     script:
+    // Run with the resident R worker on this node, if selected
+    interpreter = use_de_worker(task) ? "de_worker_client" : "Rscript"
+    // Use the fast mode if selected, or automatically for large cohorts
+    fast_required = params.deseq2_fast.toString() == "true"
+    if ( params.deseq2_fast.toString() == "auto" ) {
+        fast_mode = meta.n_samples >= params.deseq2_fast_min_samples
+    } else {
+        fast_mode = fast_required
+    }
     // Run the script in templates/run_deseq2.R
     template "run_deseq2.R"
 
@@ -37,18 +64,24 @@ process deseq2 {
 // Run the edgeR algorithm
 process edgeR {
     container "${params.container__edgeR}"
-    label "mem_medium"
-    publishDir "${params.output_folder}", mode: "copy", overwrite: true
+    label "dynamic"
+    cpus { estimate_cpus(meta, "edgeR") }
+    memory { estimate_memory(meta, "edgeR", task.attempt) }
+    // Jobs run by the resident R worker are limited to the CPUs of the task
+    beforeScript { "export DE_WORKER_TASK_CPUS=${task.cpus}" }
+    publishDir "${meta.output_folder}", mode: "copy", overwrite: true
     
     input:
     // Input file will be placed in the working directory with this name
-    tuple path(manifest), path(counts)
+    tuple val(meta), path(manifest), path(counts), path(summary)
 
     output:
     // If validation was successful, the output will be written with this path
-    path "*.edgeR.csv"
+    tuple val(meta), path("*.edgeR.csv")
 
     script:
+    // Run with the resident R worker on this node, if selected
+    interpreter = use_de_worker(task) ? "de_worker_client" : "Rscript"
     // Run the script in templates/run_edgeR.R
     template "run_edgeR.R"
 
@@ -57,27 +90,54 @@ process edgeR {
 // Run the limma voom algorithm
 process limma_voom {
     container "${params.container__edgeR}"
-    label "mem_medium"
-    publishDir "${params.output_folder}", mode: "copy", overwrite: true
+    label "dynamic"
+    cpus { estimate_cpus(meta, "limma_voom") }
+    memory { estimate_memory(meta, "limma_voom", task.attempt) }
+    // Jobs run by the resident R worker are limited to the CPUs of the task
+    beforeScript { "export DE_WORKER_TASK_CPUS=${task.cpus}" }
+    publishDir "${meta.output_folder}", mode: "copy", overwrite: true
     
     input:
     // Input file will be placed in the working directory with this name
-    tuple path(manifest), path(counts)
+    tuple val(meta), path(manifest), path(counts), path(summary)
 
     output:
     // If validation was successful, the output will be written with this path
-    path "*.limma_voom.csv"
+    tuple val(meta), path("*.limma_voom.csv")
 
     script:
+    // Run with the resident R worker on this node, if selected
+    interpreter = use_de_worker(task) ? "de_worker_client" : "Rscript"
     // Run the script in templates/run_limma_voom.R
     template "run_limma_voom.R"
 
 }
 
+// Calculate empirical p-values by permuting the comparison labels
+process permute {
+    container "${params.container__pandas}"
+    label "dynamic"
+    cpus { estimate_permute_cpus(meta) }
+    memory { estimate_permute_memory(meta, task.attempt) }
+    publishDir "${meta.output_folder}", mode: "copy", overwrite: true
+
+    input:
+    tuple val(meta), path(manifest), path(counts), path(summary)
+
+    output:
+    tuple val(meta), path("*.permutation.csv")
+
+    script:
+    // Run the script in templates/permute.py
+    template "permute.py"
+
+}
+
 workflow test {
     take:
     // Table of gene counts paired with the manifest, 
-    // validated to conform to the same order of specimens in each
+    // validated to conform to the same order of specimens in each,
+    // along with the project settings and the size of each comparison
     counts_ch
 
     main:
@@ -86,31 +146,32 @@ workflow test {
     filter(counts_ch)
 
     // The statistical test applied to the data will be determined
-    // by the parameters selected by the user
-    if ( params.algorithm == "deseq2" ){
-        
-        deseq2(filter.out)
-        csv = deseq2.out
-
-    } else if ( params.algorithm == "edgeR" ){
-        
-        edgeR(filter.out)
-        csv = edgeR.out 
-
-    } else if ( params.algorithm == "limma_voom" ){
-        
-        limma_voom(filter.out)
-        csv = limma_voom.out
+    // by the algorithm selected for each project
+    filtered_ch = filter.out.branch {
+        deseq2: it[0].algorithm == "deseq2"
+        edgeR: it[0].algorithm == "edgeR"
+        limma_voom: it[0].algorithm == "limma_voom"
+    }
+
+    deseq2(filtered_ch.deseq2)
+    edgeR(filtered_ch.edgeR)
+    limma_voom(filtered_ch.limma_voom)
+
+    results_ch = deseq2.out.mix(edgeR.out, limma_voom.out)
+
+    // Optionally, calculate empirical p-values by permutation,
+    // which are collected alongside the results of each test
+    if ( params.permutations > 0 ) {
+
+        permute(filter.out)
+
+        results_ch = results_ch
+            .join(permute.out)
+            .map { meta, results_csv, perm_csv -> [meta, [results_csv, perm_csv]] }
 
-    } else {
-        throw new Exception("""
-    ERROR:
-    Algorithm not recognized: ${params.algorithm}
-    Supported options: deseq2, edgeR, limma_voom
-        """)
     }
 
     emit:
-    results = csv
+    results = results_ch
     filtered = filter.out
-}
\ No newline at end of file
+}
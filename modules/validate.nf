@@ -1,19 +1,61 @@
+// Aggregate a cell-level AnnData object into sample-level
+// counts and manifest tables
+process pseudobulk {
+    container "${params.container__pandas}"
+    label "mem_medium"
+    publishDir "${project.output_folder}/pseudobulk/", mode: "copy", overwrite: true
+
+    input:
+    // Input file will be placed in the working directory with this name
+    tuple val(project), path(h5ad)
+
+    output:
+    tuple val(project), path("pseudobulk.counts.csv"), emit: counts
+    tuple val(project), path("pseudobulk.manifest.csv"), emit: manifest
+
+    script:
+    // Run the script in templates/pseudobulk.py
+    template "pseudobulk.py"
+
+}
+
+// Collapse the counts table to a single row of integer counts per gene,
+// moving any annotation columns to a separate table
+process features {
+    container "${params.container__pandas}"
+    label "mem_medium"
+    publishDir "${project.output_folder}/features/", mode: "copy", overwrite: true, pattern: "feature_metadata.csv"
+
+    input:
+    // Input file will be placed in the working directory with this name
+    tuple val(project), path(counts_table), path(feature_map)
+
+    output:
+    tuple val(project), path("features.counts.csv"), emit: counts
+    tuple val(project), path("feature_metadata.csv"), emit: metadata
+
+    script:
+    // Run the script in templates/collapse_features.py
+    template "collapse_features.py"
+
+}
+
 // Validate the metadata table, and reformat it as appropriate
 // to drive downstream comparisons
 process manifest {
 
     container "${params.container__pandas}"
     label "io_limited"
-    publishDir "${params.output_folder}/manifest/", mode: "copy", overwrite: true
-    
+    publishDir "${project.output_folder}/manifest/", mode: "copy", overwrite: true
+
     input:
     // Input file will be placed in the working directory with this name
-    path "input_manifest.csv"
+    tuple val(project), path("input_manifest.csv")
 
     output:
     // The output file(s) will contain the comparison column name in the file name
-    path "*.manifest.csv", emit: for_de
-    path "manifest.csv", emit: full
+    tuple val(project), path("*.manifest.csv"), emit: for_de
+    tuple val(project), path("manifest.csv"), emit: full
 
     script:
     // Run the script in templates/validate_manifest.py
@@ -21,18 +63,36 @@ process manifest {
 
 }
 
+// Calculate normalization factors for every specimen in the cohort
+process normalize {
+    container "${params.container__edgeR}"
+    label "mem_medium"
+    publishDir "${project.output_folder}/manifest/", mode: "copy", overwrite: true
+
+    input:
+    tuple val(project), path("manifest.csv"), path(counts_table)
+
+    output:
+    tuple val(project), path("norm_factors.csv")
+
+    script:
+    // Run the script in templates/normalize.R
+    template "normalize.R"
+
+}
+
 // Validate the gene count tables
 process counts {
     container "${params.container__pandas}"
     label "io_limited"
-    
+
     input:
     // Input file will be placed in the working directory with this name
-    tuple path(counts_table), path(manifest_table)
+    tuple val(project), path(counts_table), path(manifest_table), path(norm_factors)
 
     output:
     // If validation was successful, the output will be written with this path
-    tuple path("validated.${manifest_table.name}"), path("counts.csv")
+    tuple val(project), path("stats.json"), path("validated.${manifest_table.name}"), path("counts.csv"), path("summary.*.csv")
 
     script:
     // Run the script in templates/validate_counts.py
@@ -40,43 +100,200 @@ process counts {
 
 }
 
+// Combine the settings for a single project from a row of the samplesheet,
+// using the workflow parameters for any columns which were not provided
+def make_project(Map row) {
 
-workflow validate {
+    // Make sure that an output folder was defined
+    if ( params.output_folder == false ) {
+        throw new Exception("""Must specify parameter: output_folder""")
+    }
 
-    main:
+    // Make sure that the DESeq2 backend is recognized
+    if ( !(params.deseq2_fast.toString() in ["auto", "true", "false"]) ) {
+        throw new Exception("""
+    ERROR:
+    Value not recognized for deseq2_fast: ${params.deseq2_fast}
+    Supported options: auto, true, false
+        """)
+    }
 
-        // Make sure that an output folder was defined
-        if ( params.output_folder == false ) {
-            throw new Exception("""Must specify parameter: output_folder""")
+    // Projects from a samplesheet are written to their own subfolder
+    def prefix = ""
+    if ( params.samplesheet ) {
+        if ( !row.id ) {
+            throw new Exception("""Every row in the samplesheet must have an 'id'""")
         }
+        prefix = "/${row.output_prefix ?: row.id}"
+    }
+
+    // Any column included in the samplesheet takes precedence over the
+    // parameter of the same name, even when empty (e.g. no comp_ref
+    // for a continuous comparison)
+    def setting = { key -> row.containsKey(key) ? row[key] : params[key] }
+
+    def project = [
+        id: row.id ?: "project",
+        counts: setting("counts"),
+        manifest: setting("manifest"),
+        feature_map: setting("feature_map"),
+        h5ad: setting("h5ad"),
+        sample_key: setting("sample_key"),
+        h5ad_layer: setting("h5ad_layer"),
+        algorithm: setting("algorithm"),
+        comp_col: setting("comp_col"),
+        comp_ref: setting("comp_ref"),
+        group_cols: setting("group_cols"),
+        filter: setting("filter"),
+        output_folder: "${params.output_folder}${prefix}",
+        web_folder: params.web_folder ? "${params.web_folder}${prefix}" : false
+    ]
+
+    // Make sure that a comparison column was defined
+    if ( project.comp_col == "" ) {
+        throw new Exception("""Must specify parameter: comp_col (${project.id})""")
+    }
 
-        // Make sure that a comparison column was defined
-        if ( params.comp_col == "" ) {
-            throw new Exception("""Must specify parameter: comp_col""")
+    // Make sure that the algorithm is supported
+    if ( !(project.algorithm in ["deseq2", "edgeR", "limma_voom"]) ) {
+        throw new Exception("""
+    ERROR:
+    Algorithm not recognized: ${project.algorithm} (${project.id})
+    Supported options: deseq2, edgeR, limma_voom
+        """)
+    }
+
+    // Make sure that the input data was defined
+    if ( project.h5ad ) {
+        if ( project.sample_key == "" ) {
+            throw new Exception("""Must specify parameter: sample_key (${project.id})""")
         }
+    } else if ( !project.counts || !project.manifest ) {
+        throw new Exception("""Must specify parameters: counts and manifest (${project.id})""")
+    }
+
+    return project
+}
+
+
+workflow validate {
+
+    take:
+    // Rows of the samplesheet, each defining a project
+    rows_ch
+
+    main:
+
+        projects_ch = rows_ch
+            .map { row -> make_project(row) }
+            .branch {
+                h5ad: it.h5ad
+                tables: true
+            }
+
+        // If a single-cell AnnData object was provided, aggregate the
+        // cells from each sample to make the counts and manifest tables
+        pseudobulk(
+            projects_ch.h5ad.map {
+                project -> [project, file(project.h5ad, checkIfExists: true)]
+            }
+        )
+
+        // Otherwise, use the counts and manifest tables provided
+        manifest_ch = projects_ch.tables
+            .map {
+                project -> [project, file(project.manifest, checkIfExists: true)]
+            }
+            .mix(pseudobulk.out.manifest)
+
+        // Collapse the counts to one row per gene, using the
+        // feature-to-gene mapping table (if provided)
+        features(
+            projects_ch.tables
+                .map {
+                    project -> [project, file(project.counts, checkIfExists: true)]
+                }
+                .mix(pseudobulk.out.counts)
+                .map {
+                    project, counts_table -> [
+                        project,
+                        counts_table,
+                        project.feature_map ? file(project.feature_map, checkIfExists: true) : []
+                    ]
+                }
+        )
+
+        counts_ch = features.out.counts
 
         // Validate the contents of the manifest
-        
+
         // If a categorical comparison was defined, split up
         // the manifest to yield each of the appropriate pairwise
         // comparisons.
-        
+
         // If a filtering expression was specified, apply that filtering
         // before performing any additional transformations.
         manifest(
-            Channel.fromPath("${params.manifest}", checkIfExists: true)
+            manifest_ch
         )
 
+        // Record the number of comparisons made for each project,
+        // so that the results can be collected as soon as they finish
+        for_de_ch = manifest.out.for_de
+            .flatMap {
+                project, manifest_csvs ->
+                def manifest_list = [manifest_csvs].flatten()
+                manifest_list.collect {
+                    manifest_csv -> [
+                        project.id,
+                        project + [n_comparisons: manifest_list.size()],
+                        manifest_csv
+                    ]
+                }
+            }
+
+        counts_by_id = counts_ch.map { project, counts_table -> [project.id, counts_table] }
+
+        // Optionally, calculate the normalization factors once across
+        // all specimens in each project, to be used by every comparison
+        if ( params.shared_norm ) {
+
+            normalize(
+                manifest.out.full
+                    .map { project, manifest_csv -> [project.id, project, manifest_csv] }
+                    .join(counts_by_id)
+                    .map { id, project, manifest_csv, counts_table -> [project, manifest_csv, counts_table] }
+            )
+
+            norm_by_id = normalize.out.map { project, norm_csv -> [project.id, norm_csv] }
+
+        } else {
+
+            norm_by_id = manifest.out.full.map { project, manifest_csv -> [project.id, []] }
+
+        }
+
         // Validate the counts file
         counts(
-            Channel
-                .fromPath("${params.counts}")
-                .combine(
-                    manifest.out.for_de.flatten()
-                )
+            for_de_ch
+                .combine(counts_by_id, by: 0)
+                .combine(norm_by_id, by: 0)
+                .map {
+                    id, project, manifest_csv, counts_table, norm_csv -> [project, counts_table, manifest_csv, norm_csv]
+                }
         )
 
     emit:
-    counts.out        
+    // The settings for each project
+    projects = projects_ch.h5ad.mix(projects_ch.tables)
+    // Parse the size of each comparison, used to allocate resources
+    validated = counts.out.map {
+        project, stats_json, manifest_csv, counts_csv, summary_csvs -> [
+            project + new groovy.json.JsonSlurper().parseText(stats_json.text),
+            manifest_csv,
+            counts_csv,
+            summary_csvs
+        ]
+    }
 
-}
\ No newline at end of file
+}
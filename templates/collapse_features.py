@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""Collapse the rows of a counts table to a single row per gene."""
+
+import logging
+import numpy as np
+import pandas as pd
+
+# Set up logging
+logFormatter = logging.Formatter(
+    '%(asctime)s %(levelname)-8s [collapse_features] %(message)s'
+)
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Write to STDOUT
+consoleHandler = logging.StreamHandler()
+consoleHandler.setFormatter(logFormatter)
+logger.addHandler(consoleHandler)
+
+
+def get_sep(fp):
+    """Return the separator value which should be used, based on the file extension."""
+
+    # Remove the '.gz', if any
+    if fp.endswith('.gz'):
+        fp = fp[:-3]
+
+    # If the extension is .csv
+    if fp.endswith('.csv'):
+
+        # The separator is ','
+        return ','
+
+    # If the extension is .tsv
+    elif fp.endswith('.tsv'):
+
+        # The separator is '\t'
+        return '\t'
+
+    else:
+
+        msg = f"Did not recognize file extension: {fp.split('.')[-1]}"
+        raise Exception(msg)
+
+
+def read_feature_map(feature_map_fp: str) -> pd.Series:
+    """
+    Read a table mapping each feature (e.g. transcript) ID in the first
+    column to the gene ID in the second column.
+    """
+
+    logger.info(f"Reading in {feature_map_fp}")
+    feature_map = pd.read_csv(
+        feature_map_fp,
+        sep=get_sep(feature_map_fp),
+        index_col=0,
+        usecols=[0, 1]
+    ).iloc[:, 0]
+
+    # Each feature may only be assigned to a single gene
+    feature_map = feature_map.loc[~feature_map.index.duplicated()].dropna()
+    logger.info(f"Read in {feature_map.shape[0]:,} features for {feature_map.nunique():,} genes")
+    return feature_map
+
+
+def collapse_features(
+    # The paths to the counts table and feature map will be filled in by Nextflow prior to execution
+    counts_input="${counts_table}",
+    feature_map_fp="${feature_map}",
+    counts_output="features.counts.csv",
+    metadata_output="feature_metadata.csv",
+    chunk_size=100000
+):
+
+    feature_map = read_feature_map(feature_map_fp) if feature_map_fp != "" else None
+
+    # Read in the counts in chunks of rows, summing the counts
+    # for all of the rows which belong to the same gene
+    logger.info(f"Reading in {counts_input}")
+    counts_partial = []
+    metadata_partial = []
+    n_rows = 0
+    n_unmapped = 0
+
+    # For each column, the number of numeric values and the
+    # first value which could not be read as a number (if any)
+    n_numeric = None
+    invalid = dict()
+
+    for chunk in pd.read_csv(counts_input, index_col=0, sep=get_sep(counts_input), chunksize=chunk_size):
+
+        n_rows += chunk.shape[0]
+
+        # Assign each row to a gene
+        gene_ids = chunk.index.to_series()
+        if feature_map is not None:
+            mapped = gene_ids.map(feature_map)
+            n_unmapped += int(mapped.isnull().sum())
+            gene_ids = mapped.fillna(gene_ids)
+        gene_ids = gene_ids.values
+
+        # Read every value as a number, keeping track of any which are missing or invalid
+        numeric = chunk.apply(pd.to_numeric, errors="coerce")
+        if n_numeric is None:
+            n_numeric = numeric.notnull().sum()
+        else:
+            n_numeric += numeric.notnull().sum()
+        for cname in numeric.columns.values[numeric.isnull().any().values]:
+            if cname not in invalid:
+                row_ix = numeric[cname].isnull().values.argmax()
+                invalid[cname] = (chunk.index.values[row_ix], chunk[cname].values[row_ix])
+
+        counts_partial.append(numeric.groupby(gene_ids, sort=False).sum())
+
+        # Keep the text values (e.g. gene_name) of any columns which may be annotations
+        text_cols = chunk.select_dtypes(exclude="number").columns
+        if len(text_cols) > 0:
+            metadata_partial.append(chunk.reindex(columns=text_cols).groupby(gene_ids, sort=False).first())
+
+    if n_unmapped > 0:
+        logger.info(f"Keeping the original ID for {n_unmapped:,} features not found in the feature map")
+
+    # Columns without any numeric values are annotations (e.g. gene_name),
+    # and every value in all of the other columns must be a number
+    count_cols = n_numeric.index.values[n_numeric.values > 0]
+    annotation_cols = n_numeric.index.values[n_numeric.values == 0]
+    for cname in count_cols:
+        if cname in invalid:
+            feature_id, value = invalid[cname]
+            if pd.isnull(value):
+                raise Exception(f"Missing count in column '{cname}' for '{feature_id}'")
+            raise Exception(f"Invalid count in column '{cname}' for '{feature_id}': '{value}'")
+    for cname in annotation_cols:
+        logger.info(f"Treating column '{cname}' as an annotation (no numeric values)")
+
+    # Combine the sums for genes which were split across chunks
+    counts = pd.concat(counts_partial).reindex(columns=count_cols).groupby(level=0, sort=False).sum()
+    counts.index.name = "gene_id"
+    logger.info(f"Collapsed {n_rows:,} rows to {counts.shape[0]:,} genes across {counts.shape[1]:,} columns")
+
+    # Round fractional counts (e.g. from salmon) to integers
+    if not np.all(np.mod(counts.values, 1) == 0):
+        logger.info("Rounding fractional counts to integers")
+    counts = pd.DataFrame(
+        np.rint(counts.values).astype(np.int64),
+        index=counts.index,
+        columns=counts.columns
+    )
+
+    logger.info(f"Writing out {counts_output}")
+    counts.to_csv(counts_output)
+
+    # Write out the annotations for each gene
+    if len(metadata_partial) > 0:
+        metadata = pd.concat(metadata_partial).reindex(columns=annotation_cols).groupby(level=0, sort=False).first()
+    else:
+        metadata = pd.DataFrame(index=counts.index, columns=annotation_cols)
+    metadata.index.name = "gene_id"
+    logger.info(f"Writing out {metadata_output} with columns: {', '.join(metadata.columns.values)}")
+    metadata.reindex(index=counts.index).to_csv(metadata_output)
+
+
+if __name__ == "__main__":
+    collapse_features()
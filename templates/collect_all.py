@@ -20,6 +20,9 @@ logger.addHandler(consoleHandler)
 # Keep a list of all of the data that we've found
 dat = []
 
+# Empirical p-values from permutations, if any
+perm = []
+
 
 def neg_log10_pvalue(df: pd.DataFrame) -> pd.Series:
     """
@@ -39,6 +42,12 @@ for fp in os.listdir("."):
         # Parse the details of the analysis from the file name
         variable, method = fp[:-len(".csv")].split(".", 1)
 
+        # Permutation results are merged into the results of the test
+        if method == "permutation":
+            logging.info(f"Reading in permutation results for {variable} from {fp}")
+            perm.append(pd.read_csv(fp).assign(variable=variable))
+            continue
+
         logging.info(f"Reading in {method} results for {variable} from {fp}")
 
         dat.append(
@@ -71,5 +80,13 @@ df = df.rename(
     }
 )
 
+# Add the empirical p-values from permutations
+if len(perm) > 0:
+    df = df.merge(
+        pd.concat(perm),
+        on=["variable", "gene_id"],
+        how="left"
+    )
+
 # Write out to CSV
 df.to_csv("DE_results.csv", index=None)
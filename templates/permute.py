@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""Calculate empirical p-values for each gene by permuting the comparison labels."""
+
+import os
+
+# Each worker process uses a single BLAS thread
+for env_var in ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]:
+    os.environ[env_var] = "1"
+
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import numpy as np
+import pandas as pd
+
+# Set up logging
+logFormatter = logging.Formatter(
+    '%(asctime)s %(levelname)-8s [permute] %(message)s'
+)
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Write to STDOUT
+consoleHandler = logging.StreamHandler()
+consoleHandler.setFormatter(logFormatter)
+logger.addHandler(consoleHandler)
+
+# Normalized abundances shared with each worker process
+shared = dict()
+
+
+def log_cpm(counts: pd.DataFrame) -> np.ndarray:
+    """Transform counts to log2 counts per million (genes x samples)."""
+    lib_size = counts.sum().values
+    return np.log2((counts.values + 0.5) / (lib_size + 1) * 1e6)
+
+
+def center_within_strata(values: np.ndarray, strata: np.ndarray) -> np.ndarray:
+    """Subtract the mean within each stratum (along the last axis)."""
+    centered = values.astype(np.float64)
+    for stratum in np.unique(strata):
+        mask = strata == stratum
+        centered[..., mask] -= centered[..., mask].mean(axis=-1, keepdims=True)
+    return centered
+
+
+def unit_norm(values: np.ndarray, axis: int) -> np.ndarray:
+    """Scale vectors to have unit length, leaving empty vectors as zeros."""
+    norm = np.sqrt((values ** 2).sum(axis=axis, keepdims=True))
+    return np.divide(values, norm, out=np.zeros_like(values), where=norm > 0)
+
+
+def init_worker(abund: np.ndarray, label: np.ndarray, strata: np.ndarray, obs_stat: np.ndarray):
+    shared.update(abund=abund, label=label, strata=strata, obs_stat=obs_stat)
+
+
+def permute_block(seed: int, block_ix: int, n_perm: int) -> np.ndarray:
+    """
+    Count the number of permutations in which each gene has a statistic
+    at least as extreme as the observed value, computing the statistics
+    for the entire block of permutations with a single matrix product.
+    """
+
+    rng = np.random.default_rng([seed, block_ix])
+    label = shared["label"]
+    strata = shared["strata"]
+
+    # Shuffle the labels within each stratum (samples x permutations)
+    perm_labels = np.tile(label[:, None], (1, n_perm))
+    for stratum in np.unique(strata):
+        ix = np.where(strata == stratum)[0]
+        perm_labels[ix] = rng.permuted(perm_labels[ix], axis=0)
+
+    # Correlation of each gene with each permuted label (genes x permutations)
+    perm_stat = np.abs(shared["abund"] @ perm_labels)
+
+    return (perm_stat >= shared["obs_stat"][:, None] - 1e-12).sum(axis=1)
+
+
+def p_adjust(pvalues: np.ndarray, method: str) -> np.ndarray:
+    """Adjust p-values for multiple comparisons, matching p.adjust() in R."""
+
+    n = len(pvalues)
+    if method == "none" or n <= 1:
+        return pvalues
+    if method == "hommel" and n == 2:
+        method = "hochberg"
+    if method == "bonferroni":
+        return np.minimum(pvalues * n, 1)
+
+    # Scale the p-values in ascending order
+    order = np.argsort(pvalues, kind="stable")
+    p = pvalues[order]
+    rank = np.arange(1, n + 1)
+
+    if method == "holm":
+        adjusted = np.maximum.accumulate((n - rank + 1) * p)
+    elif method == "hochberg":
+        adjusted = np.minimum.accumulate(((n - rank + 1) * p)[::-1])[::-1]
+    elif method in ["BH", "fdr"]:
+        adjusted = np.minimum.accumulate((n / rank * p)[::-1])[::-1]
+    elif method == "BY":
+        q = np.sum(1 / rank)
+        adjusted = np.minimum.accumulate((q * n / rank * p)[::-1])[::-1]
+    elif method == "hommel":
+        q = np.full(n, np.min(n * p / rank))
+        adjusted = q.copy()
+        for m in range(n - 1, 1, -1):
+            q1 = np.min(m * p[n - m + 1:] / np.arange(2, m + 1))
+            q[:n - m + 1] = np.minimum(m * p[:n - m + 1], q1)
+            q[n - m + 1:] = q[n - m]
+            adjusted = np.maximum(adjusted, q)
+        adjusted = np.maximum(adjusted, p)
+    else:
+        raise Exception(f"fdr_method not recognized: {method}")
+
+    return np.minimum(adjusted, 1)[np.argsort(order)]
+
+
+def permute(
+    # The paths to the manifest and counts table will be filled in by Nextflow prior to execution
+    manifest_fp="${manifest}",
+    counts_fp="${counts}",
+    group_cols="${meta.group_cols}",
+    n_perm=int("${params.permutations}"),
+    block_size=int("${params.perm_block_size}"),
+    seed=int("${params.perm_seed}"),
+    fdr_method="${params.fdr_method}",
+    n_workers=int("${task.cpus}")
+):
+
+    # Split up the manifest filename, which has the format
+    # "validated.{comp_column}.[continuous|categorical].manifest.csv"
+    manifest_fields = manifest_fp.split(".")
+    assert len(manifest_fields) == 5, f"Unexpected manifest filename: {manifest_fp}"
+    test_col = manifest_fields[1]
+
+    logger.info(f"Reading in {manifest_fp}")
+    manifest = pd.read_csv(manifest_fp, index_col=0)
+    logger.info(f"Reading in {counts_fp}")
+    counts = pd.read_csv(counts_fp, index_col=0)
+
+    # The columns of the counts are in the same order as the manifest
+    msg = "Number of specimens does not match between the manifest and counts"
+    assert counts.shape[1] == manifest.shape[0], msg
+
+    # Permutations are only made within groups of samples which
+    # share the same values in all of the grouping columns
+    group_cols = [cname for cname in group_cols.split(",") if cname != ""]
+
+    # Continuous (numeric) grouping columns would place every sample in
+    # its own stratum, and so they are not used to define the strata
+    continuous_cols = [
+        cname for cname in group_cols
+        if pd.api.types.is_numeric_dtype(manifest[cname])
+    ]
+    if len(continuous_cols) > 0:
+        logger.info(f"Ignoring continuous grouping columns for permutation: {', '.join(continuous_cols)}")
+        group_cols = [cname for cname in group_cols if cname not in continuous_cols]
+
+    if len(group_cols) > 0:
+        strata = manifest[group_cols].astype(str).agg("|".join, axis=1).values
+    else:
+        strata = np.zeros(manifest.shape[0], dtype=int)
+    n_strata = len(np.unique(strata))
+    logger.info(f"Permuting {test_col} within {n_strata:,} strata")
+
+    # Remove the differences between strata, and scale so that
+    # the product of abundances and labels is the correlation
+    abund = unit_norm(center_within_strata(log_cpm(counts), strata), axis=1)
+    label = unit_norm(center_within_strata(manifest[test_col].values, strata), axis=0)
+    assert np.any(label != 0), f"No variation in {test_col} within strata"
+
+    obs_stat = np.abs(abund @ label)
+
+    # Split the permutations into blocks
+    blocks = [
+        (seed, block_ix, min(block_size, n_perm - start))
+        for block_ix, start in enumerate(range(0, n_perm, block_size))
+    ]
+    logger.info(f"Running {n_perm:,} permutations in {len(blocks):,} blocks")
+
+    n_extreme = np.zeros(counts.shape[0], dtype=np.int64)
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        initializer=init_worker,
+        initargs=(abund, label, strata, obs_stat)
+    ) as executor:
+        for block_extreme in executor.map(permute_block, *zip(*blocks)):
+            n_extreme += block_extreme
+
+    # Empirical p-values, counting the observed labels as one permutation
+    pvalues = (n_extreme + 1) / (n_perm + 1)
+
+    output_fp = f"{test_col}.permutation.csv"
+    logger.info(f"Writing out {output_fp}")
+    pd.DataFrame(
+        dict(
+            gene_id=counts.index.values,
+            perm_stat=abund @ label,
+            perm_pvalue=pvalues,
+            perm_qvalue=p_adjust(pvalues, fdr_method)
+        )
+    ).to_csv(output_fp, index=None)
+
+
+if __name__ == "__main__":
+    permute()
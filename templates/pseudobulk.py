@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""Aggregate a cell-level AnnData object into a sample-level counts table."""
+
+import h5py
+import logging
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Functions for reading the elements of an AnnData file,
+# which have moved between versions of anndata
+try:
+    from anndata.io import read_elem, sparse_dataset
+except ImportError:
+    from anndata.experimental import read_elem
+    try:
+        from anndata.experimental import sparse_dataset
+    except ImportError:
+        from anndata._core.sparse_dataset import SparseDataset as sparse_dataset
+
+# Set up logging
+logFormatter = logging.Formatter(
+    '%(asctime)s %(levelname)-8s [pseudobulk] %(message)s'
+)
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Write to STDOUT
+consoleHandler = logging.StreamHandler()
+consoleHandler.setFormatter(logFormatter)
+logger.addHandler(consoleHandler)
+
+
+def indicator_matrix(labels: pd.Categorical) -> sparse.csc_matrix:
+    """
+    Build a sparse (samples x cells) matrix with a 1 wherever a cell
+    belongs to a sample. Cells without a sample label are left empty.
+    Stored in CSC format so that slicing a block of cells is cheap.
+    """
+
+    keep = labels.codes >= 0
+    n_cells = len(labels)
+    return sparse.csc_matrix(
+        (
+            np.ones(keep.sum(), dtype=np.float64),
+            (labels.codes[keep], np.arange(n_cells)[keep])
+        ),
+        shape=(len(labels.categories), n_cells)
+    )
+
+
+def open_matrix(h5: h5py.File, layer: str):
+    """
+    Open the cell x gene matrix with the raw counts (X, raw.X, or a layer)
+    without reading it into memory, returning the matrix and gene names.
+    """
+
+    if layer == "":
+        path, var_path = "X", "var"
+    elif layer == "raw":
+        path, var_path = "raw/X", "raw/var"
+    else:
+        path, var_path = f"layers/{layer}", "var"
+
+    assert path in h5, f"Counts not found in the AnnData object: {path}"
+    logger.info(f"Reading counts from {path}")
+
+    # Sparse matrices are stored as a group, and dense matrices as a dataset
+    if isinstance(h5[path], h5py.Group):
+        matrix = sparse_dataset(h5[path])
+    else:
+        matrix = h5[path]
+
+    var_names = read_elem(h5[var_path]).index
+    return matrix, var_names
+
+
+def aggregate_counts(matrix, indicator: sparse.csc_matrix, chunk_size: int) -> np.ndarray:
+    """
+    Sum the counts from every cell into its sample, reading the
+    cells in blocks so that the full matrix is never loaded densely.
+    """
+
+    n_cells, n_genes = matrix.shape
+    totals = np.zeros((indicator.shape[0], n_genes), dtype=np.float64)
+
+    for start in range(0, n_cells, chunk_size):
+        end = min(start + chunk_size, n_cells)
+        logger.info(f"Aggregating cells {start:,} - {end:,} / {n_cells:,}")
+
+        # Read a block of cells from the file
+        block = matrix[start:end]
+
+        # Collapse the block with a single sparse matrix product
+        block_totals = indicator[:, start:end] @ block
+        if sparse.issparse(block_totals):
+            block_totals = block_totals.toarray()
+        totals += np.asarray(block_totals)
+
+    return totals
+
+
+def sample_manifest(obs: pd.DataFrame, labels: pd.Categorical, sample_key: str) -> pd.DataFrame:
+    """
+    Derive the sample-level manifest from the cell annotations,
+    keeping every column which has a single value within each sample.
+    """
+
+    obs = obs.assign(**{sample_key: labels}).dropna(subset=[sample_key])
+    grouped = obs.groupby(sample_key, observed=True)
+
+    # Only keep the columns which do not vary within a sample
+    constant_cols = [
+        cname
+        for cname in obs.columns.values
+        if cname != sample_key and (grouped[cname].nunique(dropna=False) <= 1).all()
+    ]
+    logger.info(f"Sample-level annotations: {', '.join(constant_cols)}")
+
+    return (
+        grouped[constant_cols]
+        .first()
+        .assign(n_cells=grouped.size())
+        .reindex(index=labels.categories)
+        .rename_axis("specimen")
+    )
+
+
+def pseudobulk(
+    # The path to the AnnData file will be filled in by Nextflow prior to execution
+    h5ad="${h5ad}",
+    sample_key="${project.sample_key}",
+    layer="${project.h5ad_layer}",
+    chunk_size=int("${params.h5ad_chunk_size}"),
+    counts_output="pseudobulk.counts.csv",
+    manifest_output="pseudobulk.manifest.csv"
+):
+
+    # Open the file without reading the cell x gene matrix into memory
+    logger.info(f"Reading in {h5ad}")
+    with h5py.File(h5ad, "r") as h5:
+
+        # Read in the cell annotations
+        obs = read_elem(h5["obs"])
+
+        matrix, var_names = open_matrix(h5, layer)
+        logger.info(f"Found {matrix.shape[0]:,} cells and {matrix.shape[1]:,} genes")
+
+        msg = "Number of cells does not match between the counts and cell annotations"
+        assert matrix.shape[0] == obs.shape[0], msg
+
+        msg = f"Sample key column not found in the cell annotations: {sample_key}"
+        assert sample_key in obs.columns.values, msg
+
+        # Assign each cell to a sample
+        labels = pd.Categorical(obs[sample_key].values)
+        labels = labels.remove_unused_categories()
+        labels = labels.rename_categories(lambda s: str(s))
+
+        n_unlabeled = int((labels.codes < 0).sum())
+        if n_unlabeled > 0:
+            logger.info(f"Ignoring {n_unlabeled:,} cells without a value for {sample_key}")
+
+        assert len(labels.categories) > 1, f"Not enough samples found in {sample_key}"
+        logger.info(f"Aggregating cells into {len(labels.categories):,} samples")
+
+        # Sum up the counts across all of the cells from each sample
+        totals = aggregate_counts(
+            matrix,
+            indicator_matrix(labels),
+            chunk_size
+        )
+
+    # The differential expression tests require raw counts, and so the
+    # aggregated values may not be normalized or log-transformed
+    if np.any(totals < 0) or not np.all(np.mod(totals, 1) == 0):
+        raise Exception(
+            "Aggregated values are not all non-negative integers, and so the matrix "
+            f"({'X' if layer == '' else layer}) does not contain raw counts. "
+            "Use the parameter h5ad_layer to select the layer (or 'raw') with the raw counts."
+        )
+    totals = totals.astype(np.int64)
+
+    # Write out the counts, with genes in rows and samples in columns
+    logger.info(f"Writing out {counts_output}")
+    pd.DataFrame(
+        totals.T,
+        index=pd.Index(var_names, name="gene_id"),
+        columns=labels.categories
+    ).to_csv(counts_output)
+
+    # Write out the manifest
+    logger.info(f"Writing out {manifest_output}")
+    sample_manifest(obs, labels, sample_key).to_csv(manifest_output)
+
+
+if __name__ == "__main__":
+    pseudobulk()
@@ -50,7 +50,12 @@ def validate_counts(
     # The path to the manifest and counts table will be filled in by Nextflow prior to execution
     manifest_csv="${manifest_table}",
     counts_input="${counts_table}",
-    counts_output="counts.csv"
+    norm_factors_csv="${norm_factors}",
+    counts_output="counts.csv",
+    stats_output="stats.json",
+    samples_output="summary.samples.csv",
+    genes_output="summary.genes.csv",
+    chunk_size=10000
 ):
 
     # Make sure that all of the expected files are present
@@ -73,33 +78,34 @@ def validate_counts(
     for n in manifest.index.values:
         logger.info(n)
 
-    # Read in the counts, using the first column as the index
-    logger.info(f"Reading in {counts_input}")
-    counts = pd.read_csv(counts_input, index_col=0, sep=get_sep(counts_input))
+    # Read in the header of the counts, using the first column as the index
+    logger.info(f"Reading in the header of {counts_input}")
+    header = pd.read_csv(counts_input, index_col=0, sep=get_sep(counts_input), nrows=0)
 
     # Check to see if any of the sample names are repeating
-    validate_unique(counts.columns.values)
+    validate_unique(header.columns.values)
 
     # Log the columns in the counts table
     logger.info("Columns in counts table:")
-    for n in counts.columns.values:
+    for n in header.columns.values:
         logger.info(n)
 
     # Correct the counts headers, accounting for the fact that many characters
     # may be coerced to periods by the upstream process
-    counts: pd.DataFrame = counts.rename(
-        columns=lambda cname: correct_cname(cname, manifest.index.values)
-    )
+    rename_cols = {
+        cname: correct_cname(cname, manifest.index.values)
+        for cname in header.columns.values
+    }
 
     # Check to see if any of the corrected values are repeating
-    validate_unique(counts.columns.values)
+    validate_unique(list(rename_cols.values()))
 
     # Make sure that every row in the manifest has a corresponding
     # column in the counts file
 
     # Get the sets of index and column values from each
     manifest_rows = set(manifest.index.values)
-    counts_cols = set(counts.columns.values)
+    counts_cols = set(rename_cols.values())
 
     # See if there are any rows in the manfiest which are missing
     # in the columns from the counts
@@ -115,20 +121,169 @@ def validate_counts(
         # Raise an error if there are no specimens remaining
         assert manifest.shape[0] > 0, "ERROR: no overlap found between manifest and counts"
 
-    # Reorder the columns of the counts to match the rows of the manifest
-    counts = counts.reindex(
-        columns=manifest.index.values
+    # The manifest filename has the format
+    # "{comp_column}.[continuous|categorical].manifest.csv"
+    comp_col, comp_type = "${manifest_table.name}".split(".")[:2]
+
+    # Summaries are also computed within each group of a categorical comparison
+    groups = manifest[comp_col] if comp_type == "categorical" else None
+
+    # Read in the counts in chunks of genes, computing all of the
+    # summary statistics in the same pass used to write out the table
+    logger.info(f"Reading in {counts_input}")
+    lib_size = pd.Series(0, index=manifest.index.values, dtype=float)
+    n_detected = pd.Series(0, index=manifest.index.values, dtype=int)
+    gene_summaries = []
+
+    for chunk_ix, counts in enumerate(
+        pd.read_csv(
+            counts_input,
+            index_col=0,
+            sep=get_sep(counts_input),
+            chunksize=chunk_size
+        )
+    ):
+
+        # Reorder the columns of the counts to match the rows of the manifest
+        counts = counts.rename(
+            columns=rename_cols
+        ).reindex(
+            columns=manifest.index.values
+        )
+
+        # Write out the counts file to a CSV
+        counts.to_csv(
+            counts_output,
+            mode="w" if chunk_ix == 0 else "a",
+            header=chunk_ix == 0
+        )
+
+        lib_size += counts.sum()
+        n_detected += (counts > 0).sum()
+        gene_summaries.append(summarize_genes(counts, groups))
+
+    gene_summary = pd.concat(gene_summaries)
+    logger.info(f"Wrote out {gene_summary.shape[0]:,} genes to {counts_output}")
+
+    # Write out the per-specimen and per-gene summaries
+    sample_summary = pd.DataFrame(
+        dict(lib_size=lib_size, n_detected=n_detected)
+    ).rename_axis(
+        "specimen"
     )
 
-    # Write out the counts file to a CSV
-    logger.info(f"Writing out {counts_output}")
-    counts.to_csv(counts_output)
+    # Add the normalization factors calculated across the entire cohort, if any
+    if norm_factors_csv != "":
+        logger.info(f"Reading in {norm_factors_csv}")
+        norm_factors = pd.read_csv(
+            norm_factors_csv,
+            index_col=0
+        ).rename(
+            index=rename_cols
+        ).reindex(
+            index=sample_summary.index.values
+        )
+
+        msg = "Normalization factors missing for some specimens"
+        assert norm_factors["size_factor"].notnull().all(), msg
+
+        sample_summary = sample_summary.assign(
+            norm_factor=norm_factors["norm_factor"],
+            size_factor=norm_factors["size_factor"]
+        )
+
+    logger.info(f"Writing out {samples_output}")
+    sample_summary.to_csv(samples_output)
+
+    logger.info(f"Writing out {genes_output}")
+    gene_summary.to_csv(genes_output)
 
     # Write out the manifest file to a CSV
     manifest_output = "validated.${manifest_table.name}"
     logger.info(f"Writing out {manifest_output}")
     manifest.to_csv(manifest_output)
 
+    # Write out the size of the comparison, used to allocate resources downstream
+    logger.info(f"Writing out {stats_output}")
+    with open(stats_output, "w") as handle:
+        json.dump(
+            comparison_stats(
+                gene_summary.shape[0],
+                int(n_detected.sum()),
+                manifest,
+                comp_col,
+                comp_type
+            ),
+            handle,
+            indent=4
+        )
+
+
+def summarize_genes(counts: pd.DataFrame, groups: pd.Series = None) -> pd.DataFrame:
+    """
+    Compute the total, mean, variance and number of zeros for each gene,
+    both across all specimens and within each group (if provided).
+    """
+
+    summary = pd.DataFrame(
+        dict(
+            total=counts.sum(axis=1),
+            mean=counts.mean(axis=1),
+            variance=counts.var(axis=1),
+            n_zero=(counts == 0).sum(axis=1)
+        )
+    )
+
+    if groups is not None:
+        for group, specimens in groups.groupby(groups).groups.items():
+            group_counts = counts.reindex(columns=specimens)
+            summary = summary.assign(
+                **{
+                    f"mean.{group}": group_counts.mean(axis=1),
+                    f"n_zero.{group}": (group_counts == 0).sum(axis=1)
+                }
+            )
+
+    return summary
+
+
+def comparison_stats(
+    n_genes: int,
+    n_nonzero: int,
+    manifest: pd.DataFrame,
+    comp_col: str,
+    comp_type: str
+) -> dict:
+    """
+    Summarize the dimensions of a comparison: the size and sparsity
+    of the counts matrix and the number of levels in each of the
+    columns used in the model.
+    """
+
+    # Any additional grouping columns
+    model_cols = [comp_col] + [
+        cname
+        for cname in "${project.group_cols}".split(",")
+        if cname != ""
+    ]
+
+    n_samples = int(manifest.shape[0])
+    n_values = n_genes * n_samples
+
+    return dict(
+        comparison=comp_col,
+        comparison_type=comp_type,
+        n_genes=int(n_genes),
+        n_samples=n_samples,
+        n_nonzero=int(n_nonzero),
+        sparsity=1 - (n_nonzero / n_values) if n_values > 0 else 0,
+        levels={
+            cname: int(manifest[cname].nunique())
+            for cname in model_cols
+            if cname in manifest.columns.values
+        }
+    )
+
 
 def correct_cname(cname: str, cnames: List[str]) -> str:
     """
@@ -37,19 +37,19 @@ def get_params():
     """Get the values defined in the Nextflow params."""
 
     # Required: Column used for comparisons
-    comp_col = "${params.comp_col}"
+    comp_col = "${project.comp_col}"
     assert comp_col != '', "Must specify parameter: comp_col"
     assert ' ' not in comp_col, "Comparison column name cannot contain spaces"
 
     # Reference value used for categorical comparisons
-    comp_ref = "${params.comp_ref}"
+    comp_ref = "${project.comp_ref}"
 
     # If no value was provided, use a null value
     if comp_ref == "":
         comp_ref = None
 
     # List of columns to use for batch correction
-    group_cols = "${params.group_cols}".split(",")
+    group_cols = "${project.group_cols}".split(",")
 
     # If no value was specified, replace with an empty list
     if len(group_cols) == 1 and group_cols[0] == "":
@@ -61,7 +61,7 @@ def get_params():
         assert ' ' not in cname, msg
 
     # Optional filtering expression to be applied
-    filter = "${params.filter}"
+    filter = "${project.filter}"
 
     # If no value was provided, use a null value
     if filter == "":